@@ -5,147 +5,298 @@
 
 import argparse
 import asyncio
+import logging
+import uvloop
 import websockets
-import json
+import orjson
+import socket
+import threading
+import mmsg
 from sys import argv
 
-# Protocol for UDP handling
-class BrokerProtocol(asyncio.Protocol):
+logger = logging.getLogger(__name__)
+
+# Static responses, serialized once and sent verbatim
+_ACK_OK = orjson.dumps({"result": "ok"})
+_ERR_UNKNOWN_REQ = orjson.dumps({"result": "error", "why": "unknown request"})
+_ERR_UNKNOWN_CONN = orjson.dumps({"result": "error", "why": "unknown connection type"})
+_ERR_NO_SERVERS = orjson.dumps({"result": "error", "why": "no servers available"})
+_ERR_TOO_MANY_CLIENTS = orjson.dumps({"result": "error", "why": "too many clients"})
+
+# Client IDs pack a slot index in the low bits and that slot's generation above it. The generation changes each time a
+# slot is reused, so replies meant for a departed client can't reach whoever takes over its slot. 19 generation bits
+# keep the largest ID within the 12 digits accepted from punch requests.
+_SLOT_BITS = 20
+_SLOT_MASK = (1 << _SLOT_BITS) - 1
+_GENERATION_MASK = (1 << 19) - 1
+
+# UDP commands
+_KEEPALIVE = b"|keepalive|"
+_PUNCH_PREFIX = b"|punchme|"
+
+# Protocol for UDP handling. Datagrams are received in batches off the event loop, then dispatched here one at a time.
+class BrokerProtocol(object):
     def __init__(self, broker: 'Broker'):
         self.broker = broker
 
-    def connection_made(self, transport):
-        self.transport = transport
-
     def datagram_received(self, data, addr):
-        if data == b"|keepalive|":
+        if data == _KEEPALIVE:
             # Always update with the most recently received keepalive
             self.broker.update(addr[0], addr[1])
             return
-        if data.startswith(b"|punchme|"):
+        if data[:9] == _PUNCH_PREFIX:
             # Send a punch based on the observed client address and port
-            _, reply_id = data.rsplit(b"|", 1)
+            reply_id = data[9:]
+            # Drop malformed requests up front. Anyone can send us garbage, and raising for each one is expensive.
+            if not reply_id.isdigit() or len(reply_id) > 12:
+                return
             self.broker.request_punch(int(reply_id), addr[0], addr[1])
 
+# How many received batches may wait for the event loop before further batches are dropped
+RECEIVE_BACKLOG = 64
+
+def offer_batch(queue, datagrams):
+    try:
+        queue.put_nowait(datagrams)
+    except asyncio.QueueFull:
+        # The event loop is behind. Drop the batch, as the kernel would once the socket buffer filled, rather than
+        # let the backlog grow without bound.
+        pass
+
+def receive_batches(sock, loop, queue):
+    # Runs on its own thread, as recvmmsg blocks. Each batch is handed to the event loop in a single callback.
+    batch = mmsg.DatagramBatch()
+    fd = sock.fileno()
+    while True:
+        count = batch.recv(fd)
+        datagrams = [(batch.datagram(i), batch.address(i)) for i in range(count)]
+        loop.call_soon_threadsafe(offer_batch, queue, datagrams)
+
 class Broker(object):
     def __init__(self):
-        # This is a dict for practical purposes, mapping remote addresses to websockets.
+        # This is a dict for practical purposes, mapping remote addresses to each server's outbox.
         # In the real world, the external address in one connection is not guaranteed to be the same as the external
         # address from another connection. So while this is helpful for troubleshooting or inspection, it's not
         # something we can rely on.
         self._connected_servers = {}
-        # Clients are just stored by an incrementing sequential ID
-        self._connected_clients = {}
-        self._next_connected_client_id = 0
+        # Clients' outboxes are stored in a list, indexed by the slot part of their ID. Slots left by disconnected
+        # clients are set to None and reused under a new generation.
+        self._connected_clients = []
+        self._client_generations = []
+        self._client_freelist = []
+        # Constructed from within main, so the loop is already running. Keep it for cheap timestamps.
+        self._loop = asyncio.get_running_loop()
         # Keep track of data on the UDP channel, and how old this information is
         self._last_update = None
         self._server_external_address = None
         self._server_external_port = 0
+        # The reply to info requests only changes when the server's external address does, so keep it serialized
+        self._info_reply = None
 
     def update(self, address, port):
-        self._last_update = asyncio.get_event_loop().time()
+        self._last_update = self._loop.time()
+        if address == self._server_external_address and port == self._server_external_port:
+            # Nothing new, which is the case for almost every keepalive
+            return
         self._server_external_address = address
         self._server_external_port = port
+        self._info_reply = orjson.dumps({
+            "result": "ok",
+            "address": address,
+            "port": port
+        })
 
     async def server_handler(self, websocket):
-        await websocket.send(json.dumps({"result": "ok"}))
+        await websocket.send(_ACK_OK)
+        # Punch requests for this server are queued in its outbox, and sent one at a time by a dedicated writer. Only
+        # this handler reads from the websocket, so the server's replies are passed back to the writer.
+        outbox = asyncio.Queue(maxsize=128)
+        replies = asyncio.Queue()
+        writer = asyncio.create_task(self._server_writer(websocket, outbox, replies))
         try:
-            self._connected_servers[websocket.remote_address] = websocket
+            self._connected_servers[websocket.remote_address] = outbox
             async for message in websocket:
-                match message.request:
-                    case _:
-                        # Unknown request
-                        await websocket.send(json.dumps({"result": "error", "why": "unknown request"}))
+                data = orjson.loads(message)
+                if "result" in data:
+                    # Reply to the punch request the writer has in flight
+                    replies.put_nowait(message)
+                    continue
+                handler = _SERVER_HANDLERS.get(data.get('request'))
+                if handler is None:
+                    # Unknown request
+                    await websocket.send(_ERR_UNKNOWN_REQ)
+                    continue
+                await handler(self, websocket, data)
         finally:
             del self._connected_servers[websocket.remote_address]
+            writer.cancel()
 
     def request_punch(self, reply_id, address, port):
         # If the client that requested the punch isn't connected, don't bother
-        if reply_id not in self._connected_clients:
+        if self._client_outbox(reply_id) is None:
             return
-        # Ask any connected servers to punch
-        for server in self._connected_servers.values():
-            asyncio.create_task(self._request_punch(server, reply_id, address, port))
-
-    async def _request_punch(self, server, reply_id, address, port):
-        await server.send(json.dumps({
-            "request": "punch",
-            "client_address": address,
-            "client_port": port
-        }))
-        # See what the server says
-        response = await server.recv()
-        # If the client that requested the punch is still connected, notify them
-        if reply_id not in self._connected_clients:
-            return
-        client = self._connected_clients[reply_id]
-        # Forward the server's reply verbatim
-        await client.send(response)
+        # Ask any connected servers to punch. The request is the same for every server, so only build it once.
+        # Addresses are plain IPv6 literals, so need no JSON escaping.
+        payload = b'{"request":"punch","client_address":"%b","client_port":%d}' % (address.encode(), port)
+        for outbox in self._connected_servers.values():
+            try:
+                outbox.put_nowait((reply_id, payload))
+            except asyncio.QueueFull:
+                # This server isn't keeping up. Drop the request rather than let its backlog grow without bound; the
+                # client will retry.
+                pass
+
+    async def _server_writer(self, server, outbox, replies):
+        try:
+            while True:
+                reply_id, payload = await outbox.get()
+                await server.send(payload)
+                # See what the server says. Punches are handled in order, so the next reply is for this request.
+                response = await replies.get()
+                # If the client that requested the punch is still connected, and hasn't been replaced by a newer one in
+                # the same slot, notify them
+                client = self._client_outbox(reply_id)
+                if client is None:
+                    continue
+                try:
+                    # Forward the server's reply verbatim
+                    client.put_nowait(response)
+                except asyncio.QueueFull:
+                    # The client isn't reading. Don't let it hold up this server's other punches.
+                    pass
+        except websockets.ConnectionClosed:
+            # The server handler cleans up once it notices
+            pass
+
+    async def _client_writer(self, client, outbox):
+        try:
+            while True:
+                await client.send(await outbox.get())
+        except websockets.ConnectionClosed:
+            # The client handler cleans up once it notices
+            pass
+
+    def _client_outbox(self, reply_id):
+        # Reply IDs come from the network, so may be beyond any slot we've handed out, or from an earlier generation
+        slot = reply_id & _SLOT_MASK
+        if slot < len(self._connected_clients) and self._client_generations[slot] == reply_id >> _SLOT_BITS:
+            return self._connected_clients[slot]
+        return None
 
     async def client_handler(self, websocket):
-        id = self._next_connected_client_id
-        self._next_connected_client_id += 1
-        await websocket.send(json.dumps({"result": "ok", "id": id}))
+        # Replies forwarded from servers go through an outbox, so a slow client never stalls a server's writer
+        outbox = asyncio.Queue(maxsize=128)
+        # Claim a slot before the first await, so concurrent connections can't be handed the same one
+        if self._client_freelist:
+            slot = self._client_freelist.pop()
+            self._connected_clients[slot] = outbox
+        elif len(self._connected_clients) <= _SLOT_MASK:
+            slot = len(self._connected_clients)
+            self._connected_clients.append(outbox)
+            self._client_generations.append(0)
+        else:
+            await websocket.send(_ERR_TOO_MANY_CLIENTS)
+            await websocket.close()
+            return
+        id = slot | (self._client_generations[slot] << _SLOT_BITS)
+        writer = asyncio.create_task(self._client_writer(websocket, outbox))
         try:
-            self._connected_clients[id] = websocket
+            await websocket.send(orjson.dumps({"result": "ok", "id": id}))
             async for message in websocket:
-                print("Got message (client): ", message)
-                data = json.loads(message)
-                match data['request']:
-                    case "info":
-                        # If we haven't heard from the server yet (or in a while), we can't return usable information
-                        if self._last_update is None or asyncio.get_event_loop().time() - self._last_update > 60:
-                            await websocket.send(json.dumps({"result": "error", "why": "no servers available"}))
-                            continue
-                        # Return the server's external address and port
-                        await websocket.send(json.dumps({
-                            "result": "ok",
-                            "address": self._server_external_address,
-                            "port": self._server_external_port
-                        }))
-                    case _:
-                        # Unknown request
-                        await websocket.send(json.dumps({"result": "error", "why": "unknown request"}))
-                        await websocket.close()
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Got message (client): %s", message)
+                data = orjson.loads(message)
+                handler = _CLIENT_HANDLERS.get(data.get('request'))
+                if handler is None:
+                    # Unknown request
+                    await websocket.send(_ERR_UNKNOWN_REQ)
+                    await websocket.close()
+                    continue
+                await handler(self, websocket, data)
         finally:
-            del self._connected_clients[id]
+            self._connected_clients[slot] = None
+            self._client_generations[slot] = (self._client_generations[slot] + 1) & _GENERATION_MASK
+            self._client_freelist.append(slot)
+            writer.cancel()
+
+    async def _handle_info(self, websocket, data):
+        # If we haven't heard from the server yet (or in a while), we can't return usable information
+        if self._last_update is None or self._loop.time() - self._last_update > 60:
+            await websocket.send(_ERR_NO_SERVERS)
+            return
+        # Return the server's external address and port
+        await websocket.send(self._info_reply)
 
     async def handler(self, websocket):
         async for message in websocket:
-            print("Got message (new): ", message)
-            match json.loads(message)['new']:
-                case "client":
-                    # Connection identifies as a client
-                    # Delegate to client handler
-                    await self.client_handler(websocket)
-                case "server":
-                    # Connection identifies as a server
-                    # Delegate to server handler
-                    await self.server_handler(websocket)
-                case _:
-                    # Unknown connection type
-                    await websocket.send(json.dumps({"result": "error", "why": "unknown connection type"}))
-                    await websocket.close()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Got message (new): %s", message)
+            # Delegate to the handler for whichever type the connection identifies as
+            handler = _CONNECTION_HANDLERS.get(orjson.loads(message).get('new'))
+            if handler is None:
+                # Unknown connection type
+                await websocket.send(_ERR_UNKNOWN_CONN)
+                await websocket.close()
+                continue
+            await handler(self, websocket)
+
+    async def receive_keepalives(self, broker_port, receivers):
+        queue = asyncio.Queue(maxsize=RECEIVE_BACKLOG)
+        # Several sockets, each with its own receiving thread. SO_REUSEPORT has the kernel spread datagrams across the
+        # sockets by flow, so each sender's datagrams still arrive in order. Only the recvmmsg syscall itself runs in
+        # parallel; unpacking each batch needs the GIL, and competes with the event loop doing the dispatch. Keep the
+        # count small.
+        for _ in range(receivers):
+            sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(("::", broker_port))
+            threading.Thread(
+                target=receive_batches,
+                args=(sock, asyncio.get_running_loop(), queue),
+                daemon=True
+            ).start()
+        protocol = BrokerProtocol(self)
+        while True:
+            for data, addr in await queue.get():
+                protocol.datagram_received(data, addr)
 
-    async def receive_keepalives(self, broker_port):
-        return await asyncio.get_running_loop().create_datagram_endpoint(
-            lambda: BrokerProtocol(self),
-            local_addr=("::", broker_port),
-            reuse_port=True
-        )
+# Request dispatch tables, mapping each request to the Broker method which handles it
+_CONNECTION_HANDLERS = {
+    "client": Broker.client_handler,
+    "server": Broker.server_handler,
+}
+_CLIENT_HANDLERS = {
+    "info": Broker._handle_info,
+}
+# Servers don't make any requests of their own yet
+_SERVER_HANDLERS = {}
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {number}")
+    return number
 
 async def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("port", type=int)
+    ap.add_argument("--receivers", type=positive_int, default=2, help="number of UDP receiving threads")
+    ap.add_argument("-v", "--verbose", action="store_true")
     args = ap.parse_args()
 
+    # Only our own logging follows --verbose. websockets stays at the default WARNING, as otherwise it logs every
+    # connection, and at DEBUG hex dumps every frame.
+    logging.basicConfig()
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
     addr = "::"
 
     broker = Broker()
-    # Listen on TCP for a reliable websocket connection, and on UDP for keepalives from the actual NAT punched flow
-    async with websockets.serve(broker.handler, addr, args.port):
-        asyncio.create_task(broker.receive_keepalives(args.port))
+    # Listen on TCP for a reliable websocket connection, and on UDP for keepalives from the actual NAT punched flow.
+    # Control messages are tiny, so compressing them costs more than it saves.
+    async with websockets.serve(broker.handler, addr, args.port, compression=None):
+        asyncio.create_task(broker.receive_keepalives(args.port, args.receivers))
         await asyncio.Future()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    uvloop.run(main())
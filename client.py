@@ -28,22 +28,91 @@
 
 import argparse
 import asyncio
+import uvloop
 import websockets
-import json
-import psutil
+import orjson
+import os
 import socket
+import struct
 from sys import stderr
 
+# Netlink sock_diag, from linux/netlink.h and linux/sock_diag.h
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+_NLMSG_HEADER = struct.Struct("=IHHII")
+# struct inet_diag_req_v2. The socket ID is left zeroed, as dumps ignore it; we filter the results ourselves.
+_INET_DIAG_REQ_V2 = struct.Struct("=BBBBI48x")
+
+def find_outbound_connection(service_addr, service_port):
+    # Ask the kernel directly for its IPv6 UDP sockets, and look for one connected to the service. This skips both
+    # /proc text parsing and building an object per socket.
+    dst = socket.inet_pton(socket.AF_INET6, service_addr)
+    dport = service_port.to_bytes(2, "big")
+    request = _INET_DIAG_REQ_V2.pack(socket.AF_INET6, socket.IPPROTO_UDP, 0, 0, 0xFFFFFFFF)
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_SOCK_DIAG) as diag:
+        diag.send(_NLMSG_HEADER.pack(
+            _NLMSG_HEADER.size + len(request), SOCK_DIAG_BY_FAMILY, NLM_F_REQUEST | NLM_F_DUMP, 1, 0
+        ) + request)
+        while True:
+            data = diag.recv(65536)
+            offset = 0
+            while offset < len(data):
+                length, msg_type, _, _, _ = _NLMSG_HEADER.unpack_from(data, offset)
+                if msg_type == NLMSG_DONE:
+                    return None
+                if msg_type == NLMSG_ERROR:
+                    err = -struct.unpack_from("=i", data, offset + _NLMSG_HEADER.size)[0]
+                    raise OSError(err, os.strerror(err))
+                # struct inet_diag_msg: family, state, timer, retrans, then the socket ID: source port, destination
+                # port, source address, destination address
+                msg = offset + _NLMSG_HEADER.size
+                if data[msg + 6:msg + 8] == dport and data[msg + 24:msg + 40] == dst:
+                    return int.from_bytes(data[msg + 4:msg + 6], "big")
+                offset += (length + 3) & ~3
+
+def scan_proc_net_udp6(service_addr, service_port):
+    # Fallback for when sock_diag is unavailable. procfs can't be mmapped, but one read plus bytes.find still leaves the
+    # searching to C, and we only split the line that matches.
+    # Each address is printed as four native endian 32 bit words, followed by the port, all in upper case hex.
+    packed = socket.inet_pton(socket.AF_INET6, service_addr)
+    needle = (
+        "".join("%08X" % word for word in struct.unpack("=4I", packed)) + ":%04X" % service_port
+    ).encode()
+    with open("/proc/net/udp6", "rb") as f:
+        table = f.read()
+    start = table.find(needle)
+    while start != -1:
+        # Make sure the match is the remote address column, not the local one
+        line_start = table.rfind(b"\n", 0, start) + 1
+        fields = table[line_start:table.find(b"\n", start)].split()
+        if fields[2] == needle:
+            return int(fields[1].rsplit(b":", 1)[1], 16)
+        start = table.find(needle, start + 1)
+    return None
+
 async def watch_for_outbound_connections(service_addr, service_port):
+    use_sock_diag = True
     while True:
-        await asyncio.sleep(1)
-        # Poll currently open connections to see if any match this description
-        for conn in psutil.net_connections(kind='udp6'):
-            # Check if the connection is to the service
-            if conn.raddr != (service_addr, service_port):
+        # sock_diag is cheap enough to poll often; reading through every socket in /proc is not
+        await asyncio.sleep(.1 if use_sock_diag else 1)
+        if use_sock_diag:
+            try:
+                local_port = find_outbound_connection(service_addr, service_port)
+            except OSError:
+                # UDP sock_diag needs the udp_diag module, which not every kernel has loaded
+                print("sock_diag unavailable, falling back to /proc/net/udp6", file=stderr)
+                use_sock_diag = False
                 continue
-            # We have a match
-            return conn.lport
+            if local_port is not None:
+                return local_port
+            continue
+        local_port = scan_proc_net_udp6(service_addr, service_port)
+        if local_port is not None:
+            return local_port
 
 async def main():
     ap = argparse.ArgumentParser()
@@ -51,27 +120,27 @@ async def main():
     ap.add_argument("broker_port", type=int)
     args = ap.parse_args()
 
-    async with websockets.connect(f'ws://[{args.broker_addr}]:{args.broker_port}') as websocket:
+    async with websockets.connect(f'ws://[{args.broker_addr}]:{args.broker_port}', compression=None) as websocket:
         # Connect the broker, get acknowledged as a client
-        await websocket.send(json.dumps({"new": "client"}))
+        await websocket.send(orjson.dumps({"new": "client"}))
         response = await websocket.recv()
-        data = json.loads(response)
+        data = orjson.loads(response)
         match data['result']:
             case "ok":
                 id = data['id']
                 pass
             case _:
-                raise Exception("Connection failed: " + response)
+                raise Exception("Connection failed: " + response.decode())
 
         # Ask the broker what the server's details are, from its perspective
-        await websocket.send(json.dumps({"request": "info"}))
+        await websocket.send(orjson.dumps({"request": "info"}))
         response = await websocket.recv()
-        data = json.loads(response)
+        data = orjson.loads(response)
         match data['result']:
             case 'ok':
                 service_addr, service_port = data['address'], data['port']
             case _:
-                raise Exception("Unknown failure: " + response)
+                raise Exception("Unknown failure: " + response.decode())
         # Present this information to the user. Eventually, the user will have a local process connect to this
         # address and port.
         print(f"{service_addr}:{service_port}")
@@ -88,39 +157,41 @@ async def main():
         # external address and port are, and there is no guarantee that NAT will map a UDP connection the same way it
         # maps our TCP connection.
 
-        while True:
-            # XXX: Here's a sticking point. The service client is unlikely to set SO_REUSEPORT, so setting the local
-            # port will likely fail. We can't wait for the service client to give up, as it is extremely unlikely that
-            # the system will give it the same local port again.
-            # We could forge packets with the correct source port, but this requires root (or more specifically,
-            # CAP_NET_RAW) on the client system. If we're going to require elevated privileges, we might as well
-            # perform a full MITM using IP_TRANSPARENT.
+        # XXX: Here's a sticking point. The service client is unlikely to set SO_REUSEPORT, so setting the local
+        # port will likely fail. We can't wait for the service client to give up, as it is extremely unlikely that
+        # the system will give it the same local port again.
+        # We could forge packets with the correct source port, but this requires root (or more specifically,
+        # CAP_NET_RAW) on the client system. If we're going to require elevated privileges, we might as well
+        # perform a full MITM using IP_TRANSPARENT.
 
-            # If the client service allows specifying the local port, this also becomes much easier, as we can perform
-            # the punch ourselves and then tell the client what local port we used. This is not common functionality,
-            # and it's also not that different from what is traditionally done with a NAT punching aware library and
-            # process.
-            with socket.socket(socket.AF_INET6, socket.SOCK_DGRAM) as broker_request:
-                # On the off chance that the client used SO_REUSEPORT, this is much simpler
-                broker_request.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-                # TODO: Something spicier when this fails.
-                broker_request.bind(("::", local_port))
-                data = b'|punchme|' + str(id).encode()
-                broker_request.sendto(data, (args.broker_addr, args.broker_port))
+        # If the client service allows specifying the local port, this also becomes much easier, as we can perform
+        # the punch ourselves and then tell the client what local port we used. This is not common functionality,
+        # and it's also not that different from what is traditionally done with a NAT punching aware library and
+        # process.
+        with socket.socket(socket.AF_INET6, socket.SOCK_DGRAM) as broker_request:
+            # On the off chance that the client used SO_REUSEPORT, this is much simpler
+            broker_request.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            # TODO: Something spicier when this fails.
+            broker_request.bind(("::", local_port))
+            # Bind once, and only resend on each retry
+            punch_request = b'|punchme|' + str(id).encode()
+            broker = (args.broker_addr, args.broker_port)
+            while True:
+                broker_request.sendto(punch_request, broker)
                 # Receive a response on the websocket
                 try:
                     async with asyncio.timeout(2):
                         response = await websocket.recv()
-                        data = json.loads(response)
+                        data = orjson.loads(response)
                         match data['result']:
                             case "ok":
                                 print("Punch successful!", file=stderr)
                                 break
                             case _:
-                                print("Punch failed: " + response, file=stderr)
+                                print("Punch failed: " + response.decode(), file=stderr)
                         break
                 except TimeoutError:
                     continue
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    uvloop.run(main())
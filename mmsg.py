@@ -0,0 +1,124 @@
+# Batched UDP I/O. Thin ctypes wrappers around recvmmsg(2) and sendmmsg(2), so a single syscall can move a whole
+# batch of datagrams rather than one at a time. Linux only.
+
+import ctypes
+import errno
+import os
+import socket
+import sys
+
+# Matches libuv's cap on datagrams per recvmmsg call
+VLEN = 32
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", msghdr),
+        ("msg_len", ctypes.c_uint),
+    ]
+
+# Not exposed by the socket module
+MSG_WAITFORONE = 0x10000
+
+# Large enough for a sockaddr_in6, which is all we ever bind
+SOCKADDR_SIZE = 28
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+_libc.recvmmsg.restype = ctypes.c_int
+_libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+_libc.sendmmsg.restype = ctypes.c_int
+
+def _decode_address(raw):
+    # struct sockaddr_in6: family, port and flowinfo (network order), address, scope id (host order). Mirror the tuple
+    # asyncio and socket.recvfrom would give us.
+    port = int.from_bytes(raw[2:4], "big")
+    flowinfo = int.from_bytes(raw[4:8], "big")
+    scope_id = int.from_bytes(raw[24:28], sys.byteorder)
+    return (socket.inet_ntop(socket.AF_INET6, raw[8:24]), port, flowinfo, scope_id)
+
+# A fixed set of buffers for receiving, and optionally replying to, up to `vlen` datagrams per syscall. Everything is
+# allocated once up front and reused for every batch.
+class DatagramBatch(object):
+    def __init__(self, vlen=VLEN, bufsize=2048):
+        self.vlen = vlen
+        self.bufsize = bufsize
+        self._buffers = (ctypes.c_char * (bufsize * vlen))()
+        self._names = (ctypes.c_char * (SOCKADDR_SIZE * vlen))()
+        self._iovecs = (iovec * vlen)()
+        self._msgs = (mmsghdr * vlen)()
+        buffers = ctypes.addressof(self._buffers)
+        names = ctypes.addressof(self._names)
+        for i in range(vlen):
+            self._iovecs[i].iov_base = buffers + i * bufsize
+            self._iovecs[i].iov_len = bufsize
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = names + i * SOCKADDR_SIZE
+            hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+            hdr.msg_iovlen = 1
+        # Replies go back to wherever each datagram came from, so share the address buffers with the receive side
+        self._reply_iovec = iovec()
+        self._reply_msgs = (mmsghdr * vlen)()
+        for i in range(vlen):
+            hdr = self._reply_msgs[i].msg_hdr
+            hdr.msg_name = names + i * SOCKADDR_SIZE
+            hdr.msg_iov = ctypes.pointer(self._reply_iovec)
+            hdr.msg_iovlen = 1
+        self._reply_payload = None
+
+    def recv(self, fd):
+        # Block until at least one datagram arrives, then take as many as are immediately available, up to vlen.
+        # Returns the number of datagrams received.
+        for i in range(self.vlen):
+            self._msgs[i].msg_hdr.msg_namelen = SOCKADDR_SIZE
+        while True:
+            count = _libc.recvmmsg(fd, self._msgs, self.vlen, MSG_WAITFORONE, None)
+            if count >= 0:
+                return count
+            err = ctypes.get_errno()
+            if err != errno.EINTR:
+                raise OSError(err, os.strerror(err))
+
+    def datagram(self, i):
+        start = i * self.bufsize
+        return self._buffers[start:start + self._msgs[i].msg_len]
+
+    def address(self, i):
+        start = i * SOCKADDR_SIZE
+        return _decode_address(self._names[start:start + SOCKADDR_SIZE])
+
+    def reply_all(self, fd, count, payload):
+        # Send the same payload back to the sender of each of the first `count` datagrams in the last batch
+        if payload is not self._reply_payload:
+            # Keep a reference, so the payload outlives the pointer to it
+            self._reply_payload = payload
+            self._reply_iovec.iov_base = ctypes.cast(ctypes.c_char_p(payload), ctypes.c_void_p)
+            self._reply_iovec.iov_len = len(payload)
+        for i in range(count):
+            self._reply_msgs[i].msg_hdr.msg_namelen = self._msgs[i].msg_hdr.msg_namelen
+        sent = 0
+        while sent < count:
+            # sendmmsg may stop short, so carry on from the first datagram not yet sent
+            result = _libc.sendmmsg(fd, ctypes.byref(self._reply_msgs[sent]), count - sent, 0)
+            if result < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                raise OSError(err, os.strerror(err))
+            sent += result
@@ -6,27 +6,50 @@
 
 import argparse
 import asyncio
+import uvloop
 from websockets.asyncio.client import connect, ClientConnection
-import json
+import orjson
 import socket
 from sys import argv
 
+# Pre-serialized acknowledgement, sent verbatim on the hot ack path
+_ACK_OK = orjson.dumps({"result": "ok"})
+
+# UDP commands
+_KEEPALIVE = b"|keepalive|"
+_PUNCH_PREFIX = b"|punchme|"
+
 # Protocol for UDP handling
 class ServerProtocol(asyncio.Protocol):
     def connection_made(self, transport):
         self.transport = transport
 
     def datagram_received(self, data, addr):
-        if data == b"|keepalive|":
+        if data == _KEEPALIVE:
             # Always update with the most recently received keepalive
             self.broker.update(addr[0], addr[1])
             return
-        if data.startswith(b"|punchme|"):
+        if data[:9] == _PUNCH_PREFIX:
             # Send a punch based on the observed client address and port
-            _, reply_id = data.rsplit(b"|", 1)
+            reply_id = data[9:]
+            # Drop malformed requests up front. Anyone can send us garbage, and raising for each one is expensive.
+            if not reply_id.isdigit() or len(reply_id) > 12:
+                return
             self.broker.request_punch(int(reply_id), addr[0], addr[1])
 
+def keepalive_socket(broker_address, broker_port, local_port):
+    # Shares the service port, so the broker sees the same NAT mapping the service's own traffic uses. Connecting it
+    # means the kernel only ever delivers the broker's traffic to it, so it can be kept open without stealing datagrams
+    # meant for the service.
+    sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("::", local_port))
+    sock.connect((broker_address, broker_port))
+    return sock
+
 def punch_hole(client_address, client_port, local_port, message=b"Pew!"):
+    # Unlike the keepalive socket, this can't be kept around: connected to the client, it would take the client's
+    # traffic from the service, and unconnected, it would take a share of everyone's.
     with socket.socket(socket.AF_INET6, socket.SOCK_DGRAM) as oneshot:
         oneshot.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         oneshot.bind(("::", local_port))
@@ -42,39 +65,46 @@ async def main():
     # Periodically send a message to the broker to keep the NAT entry alive. The broker relies on this to update its
     # record of our external address and port.
     async def keepalive():
-        while True:
-            punch_hole(args.broker_addr, args.broker_port, args.service_port, b"|keepalive|")
-            await asyncio.sleep(60)
+        with keepalive_socket(args.broker_addr, args.broker_port, args.service_port) as sock:
+            while True:
+                try:
+                    sock.send(_KEEPALIVE)
+                except OSError:
+                    # Connected UDP sockets report ICMP errors from earlier sends. The broker may just be restarting,
+                    # so keep trying.
+                    pass
+                await asyncio.sleep(60)
     asyncio.create_task(keepalive())
 
     # Create a control channel, a websocket TCP connection to the broker
-    async for websocket in connect(f'ws://[{args.broker_addr}]:{args.broker_port}'):
+    async for websocket in connect(f'ws://[{args.broker_addr}]:{args.broker_port}', compression=None):
         # Avoid accidental DDoS
         await asyncio.sleep(.1)
         # Connect to broker
-        await websocket.send(json.dumps({"new": "server"}))
+        await websocket.send(orjson.dumps({"new": "server"}))
         # Check if the connection was successful
         response = await websocket.recv()
-        match json.loads(response)['result']:
+        match orjson.loads(response)['result']:
             case "ok":
                 pass
             case _:
-                raise Exception("Connection failed: " + response)
+                raise Exception("Connection failed: " + response.decode())
 
         # Wait for the broker to make requests of us
         async for message in websocket:
-            data = json.loads(message)
+            data = orjson.loads(message)
             match data['request']:
                 case "punch":
-                    # Punch a new NAT hole
-                    await punch_hole(data['client_address'], data['client_port'], args.service_port)
+                    # Punch a new NAT hole. This only sends a single datagram, so there's no need to leave the
+                    # event loop for it.
+                    punch_hole(data['client_address'], data['client_port'], args.service_port)
 
                     # Notify the broker that the connection is ready
-                    await websocket.send(json.dumps({"result": "ok"}))
+                    await websocket.send(_ACK_OK)
                 case _:
                     # Unknown request
-                    await websocket.send(json.dumps({"result": "error"}))
+                    await websocket.send(orjson.dumps({"result": "error"}))
                     await websocket.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    uvloop.run(main())
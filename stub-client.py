@@ -3,46 +3,76 @@
 # Dumb, network agnostic client. Attempt to connect directly to the address and port provided.
 
 import argparse
+import logging
+import select
 import sys
 import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+# How long to wait for a reply before retrying
+REPLY_TIMEOUT = .4
 
 def make_socket(reuse_port=False):
     sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
     # Hahaha, good luck finding clients that let you do something like this
     if reuse_port:
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
-    sock.settimeout(.4)
+    # Wait for replies with epoll rather than through the socket's own timeout handling
+    sock.setblocking(False)
     return sock
 
+def wait_for_reply(poller, sock):
+    deadline = time.monotonic() + REPLY_TIMEOUT
+    while (remaining := deadline - time.monotonic()) > 0:
+        if not poller.poll(remaining):
+            return False
+        try:
+            sock.recvfrom(1024)
+            return True
+        except BlockingIOError:
+            # Spurious wakeup, keep waiting out the same deadline
+            continue
+    return False
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("address", type=str)
     ap.add_argument("port", type=int)
     ap.add_argument("--fresh_retry", action="store_true")
     ap.add_argument("--reuse-port", action="store_true")
+    ap.add_argument("-v", "--verbose", action="store_true")
     args = ap.parse_args()
 
+    logging.basicConfig()
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
     # Try a bunch of times. UDP is unreliable, so it's not too unreasonable to expect a client to have something
     # like this.
+    poller = select.epoll()
     try:
         sock = make_socket(args.reuse_port)
+        poller.register(sock.fileno(), select.EPOLLIN)
         for _ in range(4):
-            try:
-                print(f"Attempting to reach server at {args.address}:{args.port}")
-                sock.sendto(b"Hello, server!", (args.address, args.port))
-                data, addr = sock.recvfrom(1024)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Attempting to reach server at %s:%d", args.address, args.port)
+            sock.sendto(b"Hello, server!", (args.address, args.port))
+            if wait_for_reply(poller, sock):
                 print("Client: Connection OK")
                 sys.exit(0)
-            except socket.timeout:
-                print("Client: No reply")
+            print("Client: No reply")
             # Hope that the client doesn't create a fresh socket every time, because otherwise we're out of luck, as
             # this can demonstrate
             if args.fresh_retry:
+                poller.unregister(sock.fileno())
                 sock.close()
                 sock = make_socket(args.reuse_port)
+                poller.register(sock.fileno(), select.EPOLLIN)
         sys.exit(1)
     finally:
         sock.close()
+        poller.close()
 
 if __name__ == "__main__":
     main()
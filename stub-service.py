@@ -3,14 +3,22 @@
 # Dumb, network agnostic server. Directly listens and accepts on the port provided.
 
 import argparse
+import logging
 import socket
+import mmsg
+
+logger = logging.getLogger(__name__)
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("port", type=int)
     ap.add_argument("--reuse-port", action="store_true")
+    ap.add_argument("-v", "--verbose", action="store_true")
     args = ap.parse_args()
 
+    logging.basicConfig()
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
     print(f"Listening on port {args.port}...")
     sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
     # Give us the option of playing nicely and avoiding LD_PRELOAD shenanigans.
@@ -20,11 +28,16 @@ def main():
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     sock.bind(("::", args.port))
 
+    # Receive and reply in batches, one syscall each way per batch rather than per datagram
+    batch = mmsg.DatagramBatch(bufsize=1024)
+    reply = b"Hello, client!"
+    fd = sock.fileno()
     while True:
-        data, addr = sock.recvfrom(1024)
-        print("Server received datagram!")
+        count = batch.recv(fd)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Server received %d datagram(s)!", count)
         # Reply
-        sock.sendto(b"Hello, client!", addr)
+        batch.reply_all(fd, count, reply)
 
 if __name__ == "__main__":
     main()